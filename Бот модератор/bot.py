@@ -1,15 +1,33 @@
 import os
 import re
 import asyncio
+import secrets
+import heapq
 import logging
+import time
+from enum import Enum
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import Dict, Set, List
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Tuple, Deque, Any, Awaitable, Callable, NamedTuple
 
+import orjson
+import xxhash
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
+try:
+    import hyperscan
+except ImportError:  # Hyperscan не установлен - используем re
+    hyperscan = None
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -21,27 +39,79 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 logger.info("Загружены переменные окружения")
 
+# Настройки вебхука: если WEBHOOK_URL не задан, бот работает через поллинг
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://example.com/wh
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/wh")
+# Обязателен в режиме вебхука: без него любой, кто достучится до порта, может прислать поддельное обновление.
+# Если не задан, при запуске генерируется случайный (set_webhook регистрирует его заново при каждом старте)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
 # Инициализация бота и диспетчера
-bot = Bot(token=os.getenv("BOT_TOKEN"))
+# orjson для разбора входящих обновлений и сериализации запросов
+session = AiohttpSession(
+    json_loads=orjson.loads,
+    json_dumps=lambda obj: orjson.dumps(obj).decode()
+)
+bot = Bot(token=os.getenv("BOT_TOKEN"), session=session)
 dp = Dispatcher()
 logger.info("Инициализирован бот и диспетчер")
 
+# Точка отсчета монотонного времени процесса
+_T0 = time.monotonic()
+
+def _now() -> float:
+    """Секунды с запуска процесса (монотонно, без объектов datetime)"""
+    return time.monotonic() - _T0
+
+@dataclass(slots=True)
+class UserState:
+    """Состояние пользователя: окончание ограничения и отметки последних сообщений"""
+    ban_until: float = 0.0  # ban end time (_now() seconds), 0 - нет ограничения
+    hist: Deque[float] = field(default_factory=lambda: deque(maxlen=3))  # last 3 message times (_now() seconds)
+
 # Хранилище для отслеживания сообщений и банов
-message_history: Dict[int, List[datetime]] = defaultdict(list)  # user_id -> list of message timestamps
-user_bans: Dict[int, datetime] = {}  # user_id -> ban end time
-message_texts: Dict[str, Set[int]] = defaultdict(set)  # message_text -> set of user_ids
+users: Dict[int, UserState] = defaultdict(UserState)  # user_id -> state
+_ban_heap: List[Tuple[float, int]] = []  # (ban end time, user_id) - очередь на очистку users
+_seen: TTLCache = TTLCache(maxsize=50_000, ttl=600)  # xxh3_64(message_text) -> first user_id, хранится 10 минут
+# (chat_id, user_id) -> recent message_ids; через 48 часов Telegram уже не дает удалить сообщение
+recent_msgs: TTLCache = TTLCache(maxsize=50_000, ttl=48 * 3600)
+
+# Ограничители запросов к Telegram API: общий (30 в секунду) и на каждый чат (20 в минуту).
+# Ограничитель чата, не используемый 2 минуты, уже полностью восстановлен и удаляется
+_GLOBAL_RL = AsyncLimiter(30, 1)
+_CHAT_RL: TTLCache = TTLCache(maxsize=10_000, ttl=120)  # chat_id -> AsyncLimiter
 
 # Список исключений - ID чатов/сообществ и админов, чьи сообщения не удаляются
-EXCLUDED_SENDERS = {
+EXCLUDED_SENDERS = frozenset({
     2385254556,
     2439700122,
     2250868984,
     2299912906,
     2406705223,
     8192306358  # Админ
-}
+})
+
+# Паттерн суммы: число + к/k, с пробелом или без.
+# (?<!\d) - совпадение начинается только с первой цифры числа, иначе на длинной
+# строке из цифр backtracking перебирает каждую позицию и время растет квадратично
+_AMOUNT_RE = re.compile(r'(?<!\d)\d+\s*[кКkK]')
+# Объединенный паттерн сумм и чисел (3+ цифр) - один проход по тексту вместо двух
+_COMBINED = re.compile(r'(?<!\d)(?:(?P<amount>\d+\s*[кКkK])|(?P<num>\d{3,}))')
 
-# Стандартные разрешения для ограничения
+# Те же паттерны в базе Hyperscan (многошаблонный DFA), если библиотека доступна
+_HS_AMOUNT, _HS_NUM = 1, 2
+_hs_db = None
+if hyperscan is not None:
+    _hs_db = hyperscan.Database()
+    _hs_db.compile(
+        expressions=[r'\d+\s*[кКkK]'.encode(), rb'\d{3,}'],
+        ids=[_HS_AMOUNT, _HS_NUM],
+        flags=[hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SINGLEMATCH] * 2
+    )
+
+# Стандартные разрешения для ограничения - один экземпляр на все вызовы restrict
 restricted_permissions = types.ChatPermissions(
     can_send_messages=False,
     can_send_media_messages=False,
@@ -53,235 +123,343 @@ restricted_permissions = types.ChatPermissions(
     can_change_info=False
 )
 
-async def delete_user_messages(chat_id: int, user_id: int, message_id: int = None) -> None:
-    """Удаляет все сообщения пользователя из чата"""
-    logger.info(f"Начало удаления сообщений пользователя {user_id} из чата {chat_id}")
-    deleted_count = 0
+def set_ban(user_id: int, ban_until: float) -> None:
+    """Запоминает ограничение пользователя и ставит его в очередь на очистку"""
+    users[user_id].ban_until = ban_until
+    heapq.heappush(_ban_heap, (ban_until, user_id))
+
+def _is_idle(state: UserState, now: float) -> bool:
+    """Состояние без ограничения и без сообщений в окне спама больше не нужно"""
+    return state.ban_until == 0.0 and (not state.hist or now - state.hist[-1] > 120.0)
+
+async def _gc_bans() -> None:
+    """Фоновая очистка истекших ограничений и неактивных пользователей раз в минуту"""
+    while True:
+        await asyncio.sleep(60)
+        now = _now()
+        while _ban_heap and _ban_heap[0][0] <= now:
+            expiry, uid = heapq.heappop(_ban_heap)
+            # Пропускаем запись, если ограничение с тех пор продлили
+            state = users.get(uid)
+            if state is not None and 0.0 < state.ban_until <= expiry:
+                state.ban_until = 0.0
+                logger.debug("Очищено истекшее ограничение пользователя %s", uid)
+        
+        idle = [uid for uid, state in users.items() if _is_idle(state, now)]
+        for uid in idle:
+            del users[uid]
+        if idle:
+            logger.debug("Удалено неактивных пользователей: %s", len(idle))
+
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    """Ограничитель запросов для чата"""
+    limiter = _CHAT_RL.get(chat_id)
+    if limiter is None:
+        limiter = AsyncLimiter(20, 60)
+    _CHAT_RL[chat_id] = limiter  # повторная запись продлевает срок хранения
+    return limiter
+
+async def _limited_call(coro_factory: Callable[[], Awaitable[Any]], chat_id: int, per_chat: bool) -> Any:
+    """Выполняет запрос внутри общего и (если нужно) чатового ограничителя"""
+    if per_chat:
+        async with _chat_limiter(chat_id):
+            async with _GLOBAL_RL:
+                return await coro_factory()
+    async with _GLOBAL_RL:
+        return await coro_factory()
+
+async def tg_call(coro_factory: Callable[[], Awaitable[Any]], chat_id: int, per_chat: bool = True) -> Any:
+    """Выполняет запрос к Telegram API с учетом лимитов, при 429 повторяет один раз.
     
+    per_chat=False - запрос учитывается только в общем лимите
+    """
     try:
-        # Если передан message_id, начинаем с него, иначе пробуем получить последнее сообщение
-        if message_id:
-            start_id = message_id
+        return await _limited_call(coro_factory, chat_id, per_chat)
+    except TelegramRetryAfter as e:
+        logger.warning("Превышен лимит запросов, повтор через %s сек.", e.retry_after)
+        await asyncio.sleep(e.retry_after + 0.1)
+        return await _limited_call(coro_factory, chat_id, per_chat)
+
+async def _delete_one(chat_id: int, msg_id: int, semaphore: asyncio.Semaphore) -> None:
+    """Удаляет одно сообщение (для версий aiogram без delete_messages)"""
+    async with semaphore:
+        await tg_call(lambda: bot.delete_message(chat_id, msg_id), chat_id)
+
+def remember_message(chat_id: int, user_id: int, message_id: int) -> None:
+    """Запоминает сообщение пользователя, чтобы при ограничении удалить его"""
+    key = (chat_id, user_id)
+    ids = recent_msgs.get(key)
+    if ids is None:
+        ids = deque(maxlen=256)
+    ids.append(message_id)
+    recent_msgs[key] = ids  # повторная запись продлевает срок хранения
+
+async def delete_user_messages(chat_id: int, user_id: int) -> None:
+    """Удаляет отслеженные сообщения пользователя из чата"""
+    ids = list(recent_msgs.pop((chat_id, user_id), ()))
+    logger.info("Начало удаления %s сообщений пользователя %s из чата %s", len(ids), user_id, chat_id)
+    if not ids:
+        return
+    
+    try:
+        if hasattr(bot, "delete_messages"):
+            # Пакетное удаление - до 100 сообщений за один запрос
+            deleted_count = 0
+            for chunk in (ids[i:i + 100] for i in range(0, len(ids), 100)):
+                await tg_call(lambda: bot.delete_messages(chat_id=chat_id, message_ids=chunk), chat_id)
+                deleted_count += len(chunk)
         else:
-            start_id = 1
-            
-        # Пробуем удалить сообщения в диапазоне ±100 от текущего
-        for msg_id in range(start_id + 100, max(0, start_id - 100), -1):
-            try:
-                msg = await bot.delete_message(chat_id, msg_id)
-                deleted_count += 1
-                logger.debug(f"Удалено сообщение {msg_id}")
-            except Exception as e:
-                # Пропускаем ошибки для чужих сообщений и несуществующих
-                continue
+            semaphore = asyncio.Semaphore(25)
+            results = await asyncio.gather(
+                *[_delete_one(chat_id, msg_id, semaphore) for msg_id in ids],
+                return_exceptions=True
+            )
+            # Ошибки для уже удаленных сообщений пропускаем
+            deleted_count = sum(1 for r in results if not isinstance(r, Exception))
         
-        logger.info(f"Удалено сообщений: {deleted_count}")
+        logger.info("Удалено сообщений: %s", deleted_count)
     except Exception as e:
-        logger.error(f"Ошибка при удалении сообщений: {e}")
+        logger.error("Ошибка при удалении сообщений: %s", e)
+
+class Violation(Enum):
+    """Тип нарушения"""
+    AMOUNT = 'amount'
+    NUMERIC = 'num'
+    FLOOD = 'flood'
+    SPAM = 'spam'
+
+# Длительность ограничения за каждое нарушение
+_UNTIL: Dict[Violation, timedelta] = {
+    Violation.NUMERIC: timedelta(days=1),
+    Violation.AMOUNT: timedelta(days=7),
+    Violation.FLOOD: timedelta(days=3),
+    Violation.SPAM: timedelta(days=20),
+}
 
-async def check_numeric_sequence(message: types.Message) -> bool:
-    """Проверка на числовые последовательности"""
-    logger.debug(f"Проверка сообщения {message.message_id} на числовые последовательности")
+class Verdict(NamedTuple):
+    """Решение по сообщению: нарушение и пользователи, которых нужно ограничить"""
+    violation: Violation
+    user_ids: Tuple[int, ...]
+
+def _hs_match_numeric_patterns(text: str) -> Optional[Violation]:
+    """Проверка правил сумм и чисел через Hyperscan"""
+    matches = set()
     
-    if re.search(r'\d{3,}', message.text):
-        logger.info(f"Обнаружена числовая последовательность в сообщении {message.message_id} от пользователя {message.from_user.id}")
-        restrict_until = datetime.now() + timedelta(days=1)
-        user_bans[message.from_user.id] = restrict_until
-        
-        # Удаляем все сообщения пользователя
-        await delete_user_messages(message.chat.id, message.from_user.id, message.message_id)
-        
-        # Ограничиваем права
-        try:
-            await message.chat.restrict(
-                user_id=message.from_user.id,
-                until_date=restrict_until,
-                permissions=restricted_permissions
-            )
-            logger.info(f"Пользователь {message.from_user.id} ограничен до {restrict_until}")
-        except Exception as e:
-            logger.error(f"Ошибка при ограничении пользователя {message.from_user.id}: {e}")
-        
-        logger.info(f"Пользователь {message.from_user.id} ограничен за использование числовых последовательностей")
-        
-        return True
-    return False
+    def on_match(pattern_id: int, start: int, end: int, flags: int, context: Any) -> None:
+        matches.add(pattern_id)
+    
+    _hs_db.scan(text.encode(), match_event_handler=on_match)
+    if _HS_AMOUNT in matches:
+        return Violation.AMOUNT
+    if _HS_NUM in matches:
+        return Violation.NUMERIC
+    return None
 
-async def check_amount_mention(message: types.Message) -> bool:
-    """Проверка на упоминание сумм (число + к/k, с пробелом или без)"""
-    logger.debug(f"Проверка сообщения {message.message_id} на упоминание сумм")
+def match_numeric_patterns(text: str) -> Optional[Violation]:
+    """Определяет, сработало ли правило сумм или чисел"""
+    if _hs_db is not None:
+        return _hs_match_numeric_patterns(text)
     
-    # Паттерн для поиска: число (1+ цифр) + опциональный пробел + к/K (рус/англ)
-    if re.search(r'\d+\s*[кКkK]', message.text):
-        logger.info(f"Обнаружено упоминание суммы в сообщении {message.message_id} от пользователя {message.from_user.id}")
-        restrict_until = datetime.now() + timedelta(days=7)
-        user_bans[message.from_user.id] = restrict_until
-        
-        # Удаляем все сообщения пользователя
-        await delete_user_messages(message.chat.id, message.from_user.id, message.message_id)
-        
-        # Ограничиваем права
-        try:
-            await message.chat.restrict(
-                user_id=message.from_user.id,
-                until_date=restrict_until,
-                permissions=restricted_permissions
-            )
-            logger.info(f"Пользователь {message.from_user.id} ограничен до {restrict_until} за упоминание суммы")
-        except Exception as e:
-            logger.error(f"Ошибка при ограничении пользователя {message.from_user.id}: {e}")
-        
-        return True
-    return False
+    m = _COMBINED.search(text)
+    if m is None:
+        return None
+    if m.lastgroup == 'num' and _AMOUNT_RE.search(text, m.start()):
+        # Упоминание суммы приоритетнее, даже если оно идет после числа
+        return Violation.AMOUNT
+    return Violation(m.lastgroup)
+
+def _text_key(text: str) -> int:
+    """64-битный ключ текста для отслеживания флуда вместо полной строки"""
+    return xxhash.xxh3_64_intdigest(text.encode())
 
-async def check_flood(message: types.Message) -> bool:
-    """Проверка на одинаковые сообщения от разных пользователей"""
-    logger.debug(f"Проверка сообщения {message.message_id} на флуд")
+def check_flood(text: str, user_id: int) -> Optional[Tuple[int, ...]]:
+    """Проверка на одинаковые сообщения от разных пользователей, возвращает затронутых пользователей"""
+    h = _text_key(text)
+    first_user_id = _seen.get(h)
     
-    text = message.text
-    user_id = message.from_user.id
+    if first_user_id is not None and first_user_id != user_id:
+        # Такое же сообщение уже отправлял другой пользователь
+        del _seen[h]  # Сбрасываем отслеживание этого текста
+        return (first_user_id, user_id)
+        
+    _seen[h] = user_id
+    return None
+
+def check_spam(user_id: int, history: Deque[float], now: float) -> bool:
+    """Проверка на частый постинг: 3 сообщения за 2 минуты"""
+    # Кольцевой буфер на 3 элемента - старые отметки вытесняются сами
+    history.append(now)
+    logger.debug("Добавлено новое сообщение пользователя %s, отметок в буфере: %s", user_id, len(history))
     
-    if text in message_texts:
-        if message_texts[text]:  # Если уже есть другие пользователи с таким сообщением
-            logger.info(f"Обнаружен флуд в сообщении {message.message_id}. Текст: {text}")
-            restrict_until = datetime.now() + timedelta(days=3)
-            affected_users = message_texts[text] | {user_id}
-            
-            logger.info(f"Затронутые пользователи: {affected_users}")
-            
-            # Ограничиваем всех пользователей и удаляем их сообщения
-            for uid in affected_users:
-                try:
-                    user_bans[uid] = restrict_until
-                    await message.chat.restrict(
-                        user_id=uid,
-                        until_date=restrict_until,
-                        permissions=restricted_permissions
-                    )
-                    logger.info(f"Пользователь {uid} ограничен до {restrict_until}")
-                    await delete_user_messages(message.chat.id, uid, message.message_id)
-                except Exception as e:
-                    logger.error(f"Ошибка при ограничении пользователя {uid}: {e}")
-            
-            logger.info(f"Пользователи {affected_users} ограничены за флуд")
-            
-            message_texts[text].clear()  # Очищаем список пользователей
-            return True
-            
-    message_texts[text].add(user_id)
-    logger.debug(f"Сообщение {message.message_id} добавлено в отслеживание флуда")
+    if len(history) == 3 and now - history[0] <= 120.0:
+        history.clear()
+        return True
     return False
 
-async def check_spam(message: types.Message) -> bool:
-    """Проверка на частый постинг"""
-    logger.debug(f"Проверка сообщения {message.message_id} на спам")
+def classify(text: str, user_id: int, state: UserState, now: float) -> Optional[Verdict]:
+    """Проверяет сообщение по правилам в порядке приоритета, останавливается на первом совпадении"""
+    violation = match_numeric_patterns(text)
+    if violation is not None:
+        return Verdict(violation, (user_id,))
     
-    user_id = message.from_user.id
-    current_time = datetime.now()
+    affected_users = check_flood(text, user_id)
+    if affected_users is not None:
+        return Verdict(Violation.FLOOD, affected_users)
     
-    # Очистка старых сообщений
-    old_count = len(message_history[user_id])
-    message_history[user_id] = [
-        time for time in message_history[user_id]
-        if current_time - time <= timedelta(minutes=2)
-    ]
-    new_count = len(message_history[user_id])
+    if check_spam(user_id, state.hist, now):
+        return Verdict(Violation.SPAM, (user_id,))
+    return None
+
+async def _restrict_user(chat: types.Chat, user_id: int, restrict_until: datetime, ban_until: float) -> None:
+    """Ограничивает права пользователя и удаляет его сообщения"""
+    set_ban(user_id, ban_until)
+    try:
+        await tg_call(lambda: chat.restrict(
+            user_id=user_id,
+            until_date=restrict_until,
+            permissions=restricted_permissions
+        ), chat.id)
+        logger.info("Пользователь %s ограничен до %s", user_id, restrict_until)
+    except Exception as e:
+        logger.error("Ошибка при ограничении пользователя %s: %s", user_id, e)
     
-    if old_count != new_count:
-        logger.debug(f"Удалено {old_count - new_count} устаревших записей для пользователя {user_id}")
+    # Удаляем все сообщения пользователя
+    await delete_user_messages(chat.id, user_id)
+
+async def _punish(verdict: Verdict, message: types.Message, now: float) -> None:
+    """Применяет ограничение, соответствующее нарушению"""
+    if verdict.violation is Violation.AMOUNT:
+        logger.info("Обнаружено упоминание суммы в сообщении %s от пользователя %s", message.message_id, message.from_user.id)
+    elif verdict.violation is Violation.NUMERIC:
+        logger.info("Обнаружена числовая последовательность в сообщении %s от пользователя %s", message.message_id, message.from_user.id)
+    elif verdict.violation is Violation.FLOOD:
+        logger.info("Обнаружен флуд в сообщении %s. Текст: %s", message.message_id, message.text)
+    else:
+        logger.info("Обнаружен спам от пользователя %s в сообщении %s", message.from_user.id, message.message_id)
+    duration = _UNTIL[verdict.violation]
+    # Для Telegram нужна дата, для локальной проверки бана - время _now()
+    restrict_until = datetime.now() + duration
+    ban_until = now + duration.total_seconds()
     
-    message_history[user_id].append(current_time)
-    logger.debug(f"Добавлено новое сообщение. Всего сообщений за 2 минуты: {len(message_history[user_id])}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Затронутые пользователи: %s", verdict.user_ids)
     
-    if len(message_history[user_id]) >= 3:
-        logger.info(f"Обнаружен спам от пользователя {user_id} в сообщении {message.message_id}")
-        restrict_until = datetime.now() + timedelta(days=20)
-        user_bans[user_id] = restrict_until
-        
-        try:
-            # Удаляем все сообщения пользователя
-            await delete_user_messages(message.chat.id, user_id, message.message_id)
-            
-            # Ограничиваем права
-            await message.chat.restrict(
-                user_id=user_id,
-                until_date=restrict_until,
-                permissions=restricted_permissions
-            )
-            logger.info(f"Пользователь {user_id} ограничен до {restrict_until}")
-            
-            logger.info(f"Пользователь {message.from_user.id} ограничен за спам")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при обработке спама от пользователя {user_id}: {e}")
-        
-        message_history[user_id].clear()
-        return True
-    return False
+    if len(verdict.user_ids) == 1:
+        await _restrict_user(message.chat, verdict.user_ids[0], restrict_until, ban_until)
+    else:
+        # Ограничиваем всех затронутых пользователей параллельно (при флуде их не больше двух)
+        results = await asyncio.gather(
+            *[_restrict_user(message.chat, uid, restrict_until, ban_until) for uid in verdict.user_ids],
+            return_exceptions=True
+        )
+        for uid, result in zip(verdict.user_ids, results):
+            if isinstance(result, Exception):
+                logger.error("Ошибка при ограничении пользователя %s: %s", uid, result)
+    logger.info("Пользователи %s ограничены, нарушение: %s", verdict.user_ids, verdict.violation.value)
 
 @dp.message()
 async def handle_message(message: types.Message) -> None:
     """Обработчик всех сообщений"""
-    logger.debug(f"Получено новое сообщение {message.message_id} от пользователя {message.from_user.id}")
+    now = _now()  # единое время для проверки бана, спама и расчета ограничения
+    logger.debug("Получено новое сообщение %s от пользователя %s", message.message_id, message.from_user.id)
     
-    if not message.text:
-        logger.debug("Сообщение не содержит текст, пропускаем")
+    # Проверка на исключения - пропускаем сообщения от чатов/сообществ и админов
+    # Сначала отправитель-пользователь (обычный случай), sender_chat читаем только при необходимости
+    if (message.from_user and message.from_user.id in EXCLUDED_SENDERS) or \
+            (message.sender_chat and message.sender_chat.id in EXCLUDED_SENDERS):
+        logger.debug("Сообщение %s от исключенного отправителя, пропускаем проверки", message.message_id)
         return
     
-    # Проверка на исключения - пропускаем сообщения от чатов/сообществ и админов
-    sender_id = message.from_user.id if message.from_user else None
-    sender_chat_id = message.sender_chat.id if message.sender_chat else None
+    # Запоминаем любое сообщение (в том числе медиа), чтобы при ограничении удалить только реальные сообщения пользователя
+    if message.from_user:
+        remember_message(message.chat.id, message.from_user.id, message.message_id)
     
-    if sender_id in EXCLUDED_SENDERS or sender_chat_id in EXCLUDED_SENDERS:
-        logger.debug(f"Сообщение от исключенного отправителя (user: {sender_id}, chat: {sender_chat_id}), пропускаем проверки")
+    if not message.text:
+        logger.debug("Сообщение не содержит текст, пропускаем")
         return
 
     # Проверка на пересланные сообщения
     if message.forward_date:
-        logger.info(f"Обнаружено пересланное сообщение {message.message_id} от пользователя {message.from_user.id}")
+        logger.info("Обнаружено пересланное сообщение %s от пользователя %s", message.message_id, message.from_user.id)
         try:
-            await message.delete()
+            # Одиночное удаление не должно ждать в очереди ограничений чата
+            await tg_call(message.delete, message.chat.id, per_chat=False)
             logger.info("Пересланное сообщение удалено")
         except Exception as e:
-            logger.error(f"Ошибка при обработке пересланного сообщения: {e}")
+            logger.error("Ошибка при обработке пересланного сообщения: %s", e)
         return
 
     # Проверка на бан
     user_id = message.from_user.id
-    if user_id in user_bans:
-        if datetime.now() >= user_bans[user_id]:
-            logger.info(f"Снято ограничение с пользователя {user_id}")
-            del user_bans[user_id]
+    state = users[user_id]
+    if state.ban_until:
+        if now >= state.ban_until:
+            logger.info("Снято ограничение с пользователя %s", user_id)
+            state.ban_until = 0.0
         else:
-            logger.debug(f"Удалено сообщение от ограниченного пользователя {user_id}")
-            await message.delete()
+            logger.debug("Удалено сообщение от ограниченного пользователя %s", user_id)
+            await tg_call(message.delete, message.chat.id, per_chat=False)
             return
 
-    # Применяем все проверки
+    # Применяем все проверки: классификация синхронная, запросы к API - только для сработавшего правила
     try:
-        if await check_amount_mention(message):
-            logger.debug("Сработала проверка на упоминание суммы")
-            return
-        if await check_numeric_sequence(message):
-            logger.debug("Сработала проверка на числовые последовательности")
-            return
-        if await check_flood(message):
-            logger.debug("Сработала проверка на флуд")
-            return
-        if await check_spam(message):
-            logger.debug("Сработала проверка на спам")
-            return
+        verdict = classify(message.text, user_id, state, now)
+        if verdict is not None:
+            await _punish(verdict, message, now)
     except Exception as e:
-        logger.error(f"Ошибка при проверке сообщения {message.message_id}: {e}")
+        logger.error("Ошибка при проверке сообщения %s: %s", message.message_id, e)
+
+_background_tasks = set()
+
+@dp.startup()
+async def on_startup() -> None:
+    """Запуск фоновых задач"""
+    task = asyncio.create_task(_gc_bans())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def run_webhook() -> None:
+    """Прием обновлений через вебхук на aiohttp-сервере"""
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, сгенерирован случайный секрет для этого запуска")
+    
+    # Как и при поллинге, получаем только те типы обновлений, для которых есть обработчики
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+    logger.info("Вебхук слушает %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main() -> None:
     """Запуск бота"""
     logger.info("Запуск бота...")
     try:
-        logger.info("Начало поллинга...")
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            logger.info("Запуск вебхука %s...", WEBHOOK_URL)
+            await run_webhook()
+        else:
+            logger.info("Начало поллинга...")
+            # getUpdates не работает, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
     finally:
         logger.info("Бот остановлен")
 
@@ -292,6 +470,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+        logger.error("Критическая ошибка: %s", e)
     finally:
         logger.info("Программа завершена")